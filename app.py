@@ -1,11 +1,30 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.api_core.exceptions import ResourceExhausted
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from PIL import Image
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import array
+import functools
+import hashlib
+import io
+import logging
 import os
-from datetime import datetime
-import json
-import re
+import shutil
+import time
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+logger = logging.getLogger(__name__)
 
 # Configure page
 st.set_page_config(
@@ -14,233 +33,498 @@ st.set_page_config(
     layout="wide"
 )
 
+# Each flush adds one part file to this Parquet dataset directory
+PREDICTIONS_DIR = 'gemini_predictions'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+MODEL_NAME = 'gemini-2.0-flash-exp'
+
+# Structured output schema so Gemini always returns parseable JSON
+RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'predicted_level': {'type': 'number'},
+        'confidence': {'type': 'number'},
+        'explanation': {'type': 'string'},
+        'tube_description': {'type': 'string'},
+        'matched_reference': {'type': 'string'}
+    },
+    # Required rather than prompted for, so the details cost no prompt tokens
+    'required': [
+        'predicted_level',
+        'confidence',
+        'explanation',
+        'tube_description',
+        'matched_reference'
+    ]
+}
+
+# Reference chart levels; history stores indices into this table
+LEVELS = np.array([0.0, 0.5, 1.0, 2.0, 3.0, 5.0], dtype=np.float32)
+
+# Identical prepared images reuse a cached result for this long
+CACHE_TTL = 24 * 60 * 60
+
+# Color matching gains nothing from full-resolution phone photos
+MAX_IMAGE_SIZE = (1024, 1024)
+JPEG_QUALITY = 85
+
+# Concurrent Gemini requests for multi-image uploads
+MAX_WORKERS = 8
+
+# Confidence thresholds with how to present them, highest first
+CONFIDENCE_LADDER = (
+    (90, st.success, "🎯 Very High Confidence - Excellent match!"),
+    (75, st.info, "👍 High Confidence - Good match"),
+    (60, st.warning, "⚠️ Moderate Confidence - Consider retaking image"),
+    (float('-inf'), st.error, "❌ Low Confidence - Please check image quality")
+)
+
+# Predictions are written to disk in batches of this size
+FLUSH_EVERY = 10
+
+# Part files are merged into one on load once there are more than this many
+COMPACT_AFTER = 20
+COMPACT_LOCK = '_compact.lock'
+COMPACT_LOCK_STALE = 5 * 60
+
+def new_history():
+    """Empty column-oriented prediction history"""
+    return {
+        'timestamp': array.array('d'),
+        'level_idx': array.array('B'),
+        'confidence': array.array('B'),
+        'unit': [],
+        'explanation': []
+    }
+
+def level_index(level):
+    """Index of the reference level closest to the given value"""
+    return int(np.abs(LEVELS - level).argmin())
+
+def clamp_confidence(confidence):
+    """Round a confidence percentage into the 0-100 range stored as uint8"""
+    return round(min(max(confidence, 0), 100))
+
+def clear_history(cols):
+    """Empty history columns in place"""
+    for values in cols.values():
+        del values[:]
+
+def list_parts():
+    """Names of the committed part files in the predictions dataset"""
+    if not os.path.isdir(PREDICTIONS_DIR):
+        return []
+    return sorted(f for f in os.listdir(PREDICTIONS_DIR) if f.startswith('part-'))
+
+def write_part(table):
+    """Atomically add a table to the dataset as a new part file"""
+    os.makedirs(PREDICTIONS_DIR, exist_ok=True)
+    name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+    # Readers skip dot-prefixed files, so a half-written part is never visible
+    tmp_path = os.path.join(PREDICTIONS_DIR, f".tmp-{name}")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, os.path.join(PREDICTIONS_DIR, name))
+
+def compact_parts(table, parts):
+    """Replace many small part files with a single one holding the same rows"""
+    lock_path = os.path.join(PREDICTIONS_DIR, COMPACT_LOCK)
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        # Another session is compacting; clear the lock only if it was abandoned
+        if time.time() - os.path.getmtime(lock_path) > COMPACT_LOCK_STALE:
+            os.remove(lock_path)
+        return
+    try:
+        write_part(table)
+        for part in parts:
+            try:
+                os.remove(os.path.join(PREDICTIONS_DIR, part))
+            except FileNotFoundError:
+                pass
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+def load_history():
+    """Rehydrate prediction history from the Parquet dataset, if present"""
+    history = new_history()
+    parts = list_parts()
+    if not parts:
+        return history
+    try:
+        table = pq.ParquetDataset([os.path.join(PREDICTIONS_DIR, p) for p in parts]).read()
+    except Exception as e:
+        st.warning(f"Could not load saved history: {str(e)}")
+        return history
+    
+    # Keep startup fast as flushes accumulate small files
+    if len(parts) > COMPACT_AFTER:
+        try:
+            compact_parts(table, parts)
+        except Exception as e:
+            logger.warning("Could not compact prediction history: %s", e)
+    
+    try:
+        rows = table.sort_by('timestamp').to_pydict()
+        history['timestamp'].extend(rows['timestamp'])
+        history['level_idx'].extend(level_index(v) for v in rows['predicted_level'])
+        history['confidence'].extend(clamp_confidence(v) for v in rows['confidence'])
+        history['unit'].extend(rows['unit'])
+        history['explanation'].extend(rows['explanation'])
+    except Exception as e:
+        st.warning(f"Could not load saved history: {str(e)}")
+        return new_history()
+    return history
+
+def flush_predictions(pending):
+    """Write pending predictions as a new part file and empty the pending columns"""
+    if not pending['timestamp']:
+        return
+    write_part(pa.Table.from_pydict({
+        'timestamp': np.asarray(pending['timestamp']),
+        # Levels are stored as indices into LEVELS, which maps onto a dictionary column
+        'predicted_level': pa.DictionaryArray.from_arrays(
+            np.asarray(pending['level_idx']).astype(np.int8), LEVELS
+        ),
+        'confidence': np.asarray(pending['confidence']),
+        'unit': pending['unit'],
+        'explanation': pending['explanation']
+    }))
+    clear_history(pending)
+
+class SessionHandle:
+    """Weak-referenceable marker owned by a session's state"""
+
+def flush_on_release(pending):
+    """Flush a released session's pending rows, logging rather than dropping failures"""
+    try:
+        flush_predictions(pending)
+    except Exception:
+        logger.exception("Could not write pending predictions: %r", pending)
+
 # Initialize session state
-if 'predictions' not in st.session_state:
-    st.session_state.predictions = []
+if 'cols' not in st.session_state:
+    st.session_state.cols = load_history()
+    # Only rows added by this session are written, so sessions never overwrite each other
+    st.session_state.pending = new_history()
+    # Flushes when the session state is released, or at interpreter exit at the latest
+    st.session_state.handle = SessionHandle()
+    weakref.finalize(st.session_state.handle, flush_on_release, st.session_state.pending)
+if 'gemini_cache' not in st.session_state:
+    st.session_state.gemini_cache = {}
+if 'history_generation' not in st.session_state:
+    # Bumped on clear so cached aggregates never outlive the history they describe
+    st.session_state.history_generation = 0
+
+@st.cache_resource
+def get_gemini_model(api_key):
+    """Validate an API key and build a Gemini model bound to its own client"""
+    # genai.configure is process-global, so every key gets explicit clients instead
+    client_options = {'api_key': api_key}
+    
+    # One cheap call so a bad key raises here; failures are not cached
+    glm.ModelServiceClient(client_options=client_options).get_model(name=f'models/{MODEL_NAME}')
+    
+    model = genai.GenerativeModel(
+        MODEL_NAME,
+        generation_config={
+            'response_mime_type': 'application/json',
+            'response_schema': RESPONSE_SCHEMA
+        }
+    )
+    model._client = glm.GenerativeServiceClient(client_options=client_options)
+    return model
 
 def setup_gemini(api_key):
     """Setup Gemini API with provided API key"""
     try:
-        genai.configure(api_key=api_key)
+        get_gemini_model(api_key)
         return True
     except Exception as e:
-        st.sidebar.error(f"Invalid API key: {str(e)}")
+        st.error(f"Invalid API key: {str(e)}")
         return False
 
-def analyze_with_gemini(image, unit="mg/L"):
+def lookup_cached_result(image_key, unit):
+    """Return a cached result for an identical image, if any"""
+    now = time.time()
+    cache = st.session_state.gemini_cache
+    # Drop entries older than the TTL to bound memory
+    for key, (stored, _) in list(cache.items()):
+        if now - stored > CACHE_TTL:
+            cache.pop(key, None)
+    entry = cache.get((unit, image_key))
+    return entry[1] if entry is not None else None
+
+def store_cached_result(image_key, unit, result):
+    """Remember a Gemini result for this image"""
+    st.session_state.gemini_cache[(unit, image_key)] = (time.time(), result)
+
+@st.cache_data(max_entries=8)
+def decode_image(raw):
+    """Decode uploaded image bytes to an RGB PIL image"""
+    return Image.open(io.BytesIO(raw)).convert('RGB')
+
+@st.cache_data(max_entries=8)
+def prepare_image(raw):
+    """Downscale and JPEG-encode uploaded image bytes for the Gemini API"""
+    img = Image.open(io.BytesIO(raw))
+    img.thumbnail(MAX_IMAGE_SIZE, Image.LANCZOS)
+    buf = io.BytesIO()
+    img.convert('RGB').save(buf, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+@functools.lru_cache(maxsize=None)
+def build_prompt(unit):
+    """Build the analysis prompt; output structure comes from RESPONSE_SCHEMA"""
+    return (
+        "Match the test-tube liquid to the nearest reference color. "
+        f"Allowed levels: 0.0, 0.5, 1.0, 2.0, 3.0, 5.0 {unit}. "
+        "Confidence is 0-100."
+    )
+
+@retry(
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type(ResourceExhausted),
+    reraise=True
+)
+def generate_with_retry(model, contents):
+    """Start a streamed Gemini call, backing off when rate limited"""
+    return model.generate_content(contents, stream=True)
+
+def analyze_with_gemini(image_data, api_key, unit="mg/L", placeholder=None):
     """Analyze nitrite test kit image using Gemini"""
     try:
-        # Initialize the model
-        model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        # Serve repeated uploads of the same test kit photo from cache
+        # Key on the exact bytes: perceptual hashes ignore the tube color we classify
+        image_key = hashlib.sha256(image_data).hexdigest()
+        cached = lookup_cached_result(image_key, unit)
+        if cached is not None:
+            return cached
+        
+        # Get the cached model
+        model = get_gemini_model(api_key)
         
         # Create the prompt
-        prompt = f"""
-        You are an expert at analyzing water test kit results. Please analyze this nitrite test kit image.
-
-        I can see a test tube with colored liquid and a reference color chart. Please:
-
-        1. Identify the test tube in the image (it's usually a clear glass tube with pink/clear liquid)
-        2. Compare the color of the liquid in the test tube to the reference color chart shown in the image
-        3. Determine which reference color (0.0, 0.5, 1.0, 2.0, 3.0, or 5.0 {unit}) best matches the test tube liquid
-        4. Provide a confidence level (0-100%) for your assessment
-
-        Please respond in the following JSON format:
-        {{
-            "predicted_level": <number>,
-            "confidence": <number 0-100>,
-            "explanation": "<brief explanation of what you observed>",
-            "tube_description": "<description of the test tube liquid color>",
-            "matched_reference": "<description of the matching reference color>"
-        }}
-
-        Be very precise in your color matching. Look carefully at the liquid inside the test tube and compare it to each reference color block.
-        """
+        prompt = build_prompt(unit)
         
         # Generate response
-        response = model.generate_content([prompt, image])
+        response = generate_with_retry(model, [prompt, {'mime_type': 'image/jpeg', 'data': image_data}])
+        
+        # Show the reply as it streams in
+        text = ""
+        for chunk in response:
+            text += chunk.text
+            if placeholder is not None:
+                placeholder.code(text, language="json")
+        response.resolve()
         
         # Parse JSON response
-        try:
-            # Extract JSON from response
-            json_match = re.search(r'\{.*\}', response.text, re.DOTALL)
-            if json_match:
-                result = json.loads(json_match.group())
-                return result
-            else:
-                # Fallback parsing if JSON is not properly formatted
-                return parse_text_response(response.text)
-                
-        except json.JSONDecodeError:
-            return parse_text_response(response.text)
+        result = _json.loads(text)
+        store_cached_result(image_key, unit, result)
+        return result
             
     except Exception as e:
         st.error(f"Error analyzing image: {str(e)}")
         return None
+    finally:
+        # Never leave partially streamed text on screen
+        if placeholder is not None:
+            placeholder.empty()
 
-def parse_text_response(text):
-    """Parse text response if JSON parsing fails"""
-    try:
-        # Extract numerical values using regex
-        level_match = re.search(r'(?:level|prediction).*?(\d+\.?\d*)', text, re.IGNORECASE)
-        confidence_match = re.search(r'confidence.*?(\d+)', text, re.IGNORECASE)
-        
-        predicted_level = float(level_match.group(1)) if level_match else 1.0
-        confidence = float(confidence_match.group(1)) if confidence_match else 50.0
-        
-        return {
-            "predicted_level": predicted_level,
-            "confidence": confidence,
-            "explanation": text[:200] + "..." if len(text) > 200 else text,
-            "tube_description": "AI analysis completed",
-            "matched_reference": f"Closest match: {predicted_level} mg/L"
-        }
-    except:
-        return {
-            "predicted_level": 1.0,
-            "confidence": 50.0,
-            "explanation": "Could not parse detailed results",
-            "tube_description": "Analysis attempted",
-            "matched_reference": "Default result"
-        }
+def analyze_batch(image_data, api_key, unit="mg/L"):
+    """Analyze several images concurrently; Gemini calls are network-bound"""
+    # Placeholders are created up front so streamed text keeps upload order
+    placeholders = [st.empty() for _ in image_data]
+    if len(image_data) == 1:
+        return [analyze_with_gemini(image_data[0], api_key, unit, placeholders[0])]
+    
+    # Worker threads need the script context to use session state and st.* calls
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(
+        max_workers=min(MAX_WORKERS, len(image_data)),
+        initializer=add_script_run_ctx,
+        initargs=(None, ctx)
+    ) as executor:
+        return list(executor.map(
+            lambda args: analyze_with_gemini(args[0], api_key, unit, args[1]),
+            zip(image_data, placeholders)
+        ))
 
 def save_prediction(level, confidence, unit, explanation=""):
-    """Save prediction to CSV file"""
-    new_prediction = {
-        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'predicted_level': level,
-        'confidence': confidence,
+    """Save prediction to history and periodically to disk"""
+    # Add to session state and to the rows awaiting a write
+    row = {
+        'timestamp': time.time(),
+        'level_idx': level_index(level),
+        'confidence': clamp_confidence(confidence),
         'unit': unit,
         'explanation': explanation
     }
+    pending = st.session_state.pending
+    for cols in (st.session_state.cols, pending):
+        for key, value in row.items():
+            cols[key].append(value)
     
-    # Add to session state
-    st.session_state.predictions.append(new_prediction)
+    # Write to disk once enough predictions have accumulated
+    if len(pending['timestamp']) >= FLUSH_EVERY:
+        flush_predictions(pending)
+
+def history_stats(cols):
+    """Average level and confidence, recomputed only when history changes"""
+    key = (len(cols['timestamp']), st.session_state.history_generation)
+    cached = st.session_state.get('history_stats')
+    if cached is None or cached[0] != key:
+        mean_level = LEVELS[np.frombuffer(cols['level_idx'], dtype=np.uint8)].mean()
+        mean_conf = np.frombuffer(cols['confidence'], dtype=np.uint8).mean()
+        cached = (key, mean_level, mean_conf)
+        st.session_state.history_stats = cached
+    return cached[1], cached[2]
+
+def format_timestamps(timestamps):
+    """Format epoch seconds as local time strings, honouring DST per row"""
+    return [time.strftime(TIMESTAMP_FORMAT, time.localtime(t)) for t in timestamps]
+
+def display_result(result, unit):
+    """Show a single analysis result and record it in history"""
+    if result:
+        # Display results
+        st.success("✅ AI Analysis Complete!")
+        
+        # Main result, snapped to the chart level that history will record
+        level = float(LEVELS[level_index(result['predicted_level'])])
+        st.markdown(f"""
+        ### 🎯 Predicted Nitrite Level: **{level} {unit}**
+        **AI Confidence:** {result['confidence']:.1f}%
+        """)
+        if level != result['predicted_level']:
+            st.caption(f"AI reported {result['predicted_level']} {unit}; rounded to the nearest chart level.")
+        
+        # Progress bar for confidence
+        st.progress(clamp_confidence(result['confidence']) / 100)
+        
+        # Save prediction
+        save_prediction(
+            result['predicted_level'], 
+            result['confidence'], 
+            unit, 
+            result.get('explanation', '')
+        )
+        
+        # Detailed analysis
+        with st.expander("🔍 Detailed AI Analysis"):
+            st.markdown(f"**Test Tube Description:** {result.get('tube_description', 'N/A')}")
+            st.markdown(f"**Matched Reference:** {result.get('matched_reference', 'N/A')}")
+            st.markdown(f"**AI Explanation:** {result.get('explanation', 'N/A')}")
+        
+        # Confidence interpretation
+        confidence = result['confidence']
+        show, message = next(
+            (fn, msg) for threshold, fn, msg in CONFIDENCE_LADDER if confidence >= threshold
+        )
+        show(message)
     
-    # Save to CSV
-    df = pd.DataFrame(st.session_state.predictions)
-    df.to_csv('gemini_predictions.csv', index=False)
+    else:
+        st.error("❌ Could not analyze the image. Please try again.")
 
 def main():
     st.title("🧪 AI-Powered Nitrite Test Kit Analysis")
     st.markdown("Upload your test kit image and let AI analyze it instantly!")
     
-    # Sidebar for settings
-    st.sidebar.header("Settings")
-    
-    # API Key input
-    st.sidebar.subheader("Gemini API Key")
-    api_key = st.sidebar.text_input(
-        "Enter your Gemini API Key",
-        type="password",
-        help="Enter your Google Gemini API key to enable AI analysis"
-    )
-    
-    # Validate API key
-    api_key_valid = False
-    if api_key:
-        api_key_valid = setup_gemini(api_key)
-    
-    unit = st.sidebar.selectbox(
-        "Choose unit:",
-        ["mg/L", "ppm"],
-        index=0
-    )
-    
-    # File upload
-    uploaded_file = st.file_uploader(
-        "Choose an image...",
-        type=['jpg', 'jpeg', 'png'],
-        help="Upload an image of your nitrite test kit"
-    )
+    # Inputs only trigger a rerun when the form is submitted
+    with st.form("analyze", clear_on_submit=False):
+        key_col, unit_col = st.columns([2, 1])
+        
+        # API Key input
+        api_key = key_col.text_input(
+            "Enter your Gemini API Key",
+            type="password",
+            help="Enter your Google Gemini API key to enable AI analysis"
+        )
+        
+        unit = unit_col.selectbox(
+            "Choose unit:",
+            ["mg/L", "ppm"],
+            index=0
+        )
+        
+        # File upload
+        uploaded_files = st.file_uploader(
+            "Choose images...",
+            type=['jpg', 'jpeg', 'png'],
+            accept_multiple_files=True,
+            help="Upload one or more images of your nitrite test kit"
+        )
+        
+        # Analyze button
+        submitted = st.form_submit_button("🔍 Analyze with AI", type="primary")
     
-    if uploaded_file is not None:
-        # Load and display image
-        image = Image.open(uploaded_file)
+    if uploaded_files:
+        # Load and display images
+        images = [decode_image(f.getvalue()) for f in uploaded_files]
         
         # Create columns for layout
         col1, col2 = st.columns([1, 1])
         
         with col1:
-            st.subheader("📷 Uploaded Image")
-            st.image(image, caption="Test Kit Image", use_container_width=True)
+            st.subheader("📷 Uploaded Images")
+            st.image(images, caption=[f.name for f in uploaded_files], use_container_width=True)
         
         with col2:
             st.subheader("🤖 AI Analysis")
             
-            # Analyze button
-            if st.button("🔍 Analyze with AI", type="primary", disabled=not api_key_valid):
-                if not api_key_valid:
-                    st.error("Please enter a valid Gemini API key in the sidebar")
+            if submitted:
+                # Validate API key
+                if not api_key or not setup_gemini(api_key):
+                    st.error("Please enter a valid Gemini API key above")
                 else:
                     with st.spinner("AI is analyzing your test kit..."):
-                        result = analyze_with_gemini(image, unit)
-                    
-                    if result:
-                        # Display results
-                        st.success("✅ AI Analysis Complete!")
-                        
-                        # Main result
-                        st.markdown(f"""
-                        ### 🎯 Predicted Nitrite Level: **{result['predicted_level']} {unit}**
-                        **AI Confidence:** {result['confidence']:.1f}%
-                        """)
-                        
-                        # Progress bar for confidence
-                        st.progress(result['confidence'] / 100)
-                        
-                        # Save prediction
-                        save_prediction(
-                            result['predicted_level'], 
-                            result['confidence'], 
-                            unit, 
-                            result.get('explanation', '')
-                        )
-                        
-                        # Detailed analysis
-                        with st.expander("🔍 Detailed AI Analysis"):
-                            st.markdown(f"**Test Tube Description:** {result.get('tube_description', 'N/A')}")
-                            st.markdown(f"**Matched Reference:** {result.get('matched_reference', 'N/A')}")
-                            st.markdown(f"**AI Explanation:** {result.get('explanation', 'N/A')}")
-                        
-                        # Confidence interpretation
-                        confidence = result['confidence']
-                        if confidence >= 90:
-                            st.success("🎯 Very High Confidence - Excellent match!")
-                        elif confidence >= 75:
-                            st.info("👍 High Confidence - Good match")
-                        elif confidence >= 60:
-                            st.warning("⚠️ Moderate Confidence - Consider retaking image")
-                        else:
-                            st.error("❌ Low Confidence - Please check image quality")
+                        image_data = [prepare_image(f.getvalue()) for f in uploaded_files]
+                        results = analyze_batch(image_data, api_key, unit)
                     
-                    else:
-                        st.error("❌ Could not analyze the image. Please try again.")
+                    for uploaded_file, result in zip(uploaded_files, results):
+                        if len(uploaded_files) > 1:
+                            st.markdown(f"#### 📄 {uploaded_file.name}")
+                        display_result(result, unit)
+    elif submitted:
+        st.warning("Please upload at least one image to analyze")
     
     # History section
     st.markdown("---")
     st.subheader("📊 Analysis History")
     
-    if st.session_state.predictions:
-        df = pd.DataFrame(st.session_state.predictions)
-        
-        # Display recent predictions
-        st.dataframe(df.tail(10), use_container_width=True)
+    cols = st.session_state.cols
+    if cols['timestamp']:
+        # Display recent predictions without building the full history frame
+        recent = {
+            'timestamp': format_timestamps(cols['timestamp'][-10:]),
+            'predicted_level': LEVELS[np.asarray(cols['level_idx'][-10:])],
+            'confidence': np.asarray(cols['confidence'][-10:]),
+            'unit': cols['unit'][-10:],
+            'explanation': cols['explanation'][-10:]
+        }
+        st.dataframe(recent, use_container_width=True)
         
         # Simple statistics
-        if len(df) > 1:
+        if len(cols['timestamp']) > 1:
+            mean_level, mean_conf = history_stats(cols)
             col_a, col_b, col_c = st.columns(3)
             with col_a:
-                st.metric("Total Tests", len(df))
+                st.metric("Total Tests", len(cols['timestamp']))
             with col_b:
-                st.metric("Average Level", f"{df['predicted_level'].mean():.1f} {unit}")
+                st.metric("Average Level", f"{mean_level:.1f} {unit}")
             with col_c:
-                st.metric("Average Confidence", f"{df['confidence'].mean():.1f}%")
+                st.metric("Average Confidence", f"{mean_conf:.1f}%")
         
         # Clear history button
         if st.button("🗑️ Clear History"):
-            st.session_state.predictions = []
-            if os.path.exists('gemini_predictions.csv'):
-                os.remove('gemini_predictions.csv')
+            # Clear in place so the release flush sees the emptied columns
+            clear_history(cols)
+            clear_history(st.session_state.pending)
+            st.session_state.history_generation += 1
+            shutil.rmtree(PREDICTIONS_DIR, ignore_errors=True)
             st.rerun()
     else:
         st.info("No analyses yet. Upload an image to get started!")